@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: copyleft-next-0.3.1
 import os
+import gzip
+import hashlib
 import subprocess
 import sys
 import logging
@@ -8,27 +10,59 @@ import argparse
 import time
 import yaml
 import json
+import urllib.error
 import urllib.request
+from typing import Callable
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+CACHE_TTL = 86400
+# Bump whenever the generated Kconfig format changes to invalidate caches
+CACHE_VERSION = 2
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "kdevops"
+)
 
 
 def popen(
-    cmd: list[str], environ: dict[str, str] = {}, comm: bool = True
-) -> subprocess.Popen[bytes]:
-    try:
-        logging.debug(f"{' '.join(cmd)}")
-        p = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ
-        )
-        if comm:
-            stdout, stderr = p.communicate()
-            if stdout:
-                logging.debug(stdout.decode("utf-8"))
-            if stderr:
-                logging.debug(stderr.decode("utf-8"))
-            logging.debug(f"Return code: {p.returncode}")
-        return {"process": p, "stdout": stdout.decode("utf-8")}
-    except subprocess.CalledProcessError as exc:
-        sys.exit(exc.returncode)
+    cmd: list[str],
+    environ: dict[str, str] = {},
+    keep: Callable[[str], bool] | None = None,
+) -> dict:
+    """Run cmd and collect its stdout lines.
+
+    Output is read line by line. When keep is given, only the lines for
+    which keep(line) returns True are collected. stderr is not captured,
+    it goes to the terminal with --debug and is discarded otherwise.
+    """
+    logging.debug(f"{' '.join(cmd)}")
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=None if debug else subprocess.DEVNULL,
+        env=environ,
+    )
+    lines = []
+    for line in p.stdout:
+        line = line.decode("utf-8").rstrip("\n")
+        if keep is None or keep(line):
+            lines.append(line)
+    p.stdout.close()
+    p.wait()
+    if debug:
+        if lines:
+            logging.debug("\n".join(lines))
+        logging.debug(f"Return code: {p.returncode}")
+    return {"process": p, "stdout": lines}
 
 
 def parser():
@@ -82,6 +116,13 @@ def parser():
         help="number of references",
         required=True,
     )
+    gitref.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=3600,
+        help="seconds to reuse a cached generated output, 0 to disable; "
+        "--force always regenerates and refreshes the cache",
+    )
     kreleases = subparsers.add_parser("kreleases", help="kernel.org/releases.json")
     kreleases.add_argument(
         "--moniker",
@@ -91,50 +132,83 @@ def parser():
     return parser
 
 
-def check_file_date(file):
-    if not os.path.exists(file):
-        return True
-    modified_time = os.path.getmtime(file)
-    current_time = time.time()
-    if current_time - modified_time > 86400:
+def check_file_date(file, ttl=CACHE_TTL):
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
         return True
-    return False
-
-
-def _ref_generator_choices_static(args, conf_name, ref_name, ref_help):
-    refs = {}
-    with open(args.output, "a") as f:
-        logging.debug("static: {}".format(ref_name))
-        refs.update({ref_name: conf_name})
-        f.write("config {config}\n".format(config=conf_name))
-        # Do overwrite ref when custom
-        if "_CUSTOM_NAME" in ref_name:
-            f.write('\tbool "custom"\n'.format(ref=ref_name))
-        else:
-            f.write('\tbool "{ref}"\n'.format(ref=ref_name))
-        if ref_help:
-            f.write("\thelp\n")
-            f.write("\t\t{help}\n\n".format(help=ref_help))
-        else:
-            f.write("\n")
-    return refs
+    return time.time() - st.st_mtime > ttl
 
 
-def _ref_generator_choices(args, reflist, id) -> None:
-    refs = {}
-    # for refline in reflist.splitlines():
-    for ref_name in reflist:
-        logging.debug("{}: {}".format(id, ref_name))
-        config = "{prefix}_REF_{id}".format(prefix=args.prefix, id=id)
-        refs.update({ref_name: config})
-        with open(args.output, "a") as f:
-            f.write("config {conf}\n".format(conf=config))
-            f.write('\t bool "{ref}"\n\n'.format(ref=ref_name))
-        id += 1
-    return refs
+def cache_read(name):
+    """Return the cached bytes for name, or None if not cached."""
+    try:
+        with open(os.path.join(CACHE_DIR, name), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cache_write(name, data):
+    """Atomically store data under name. Caching is best effort."""
+    path = os.path.join(CACHE_DIR, name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError as exc:
+        logging.debug(f"Unable to write cache {path}: {exc}")
+
+
+def _stamp(file):
+    key = hashlib.sha1(os.path.abspath(file).encode("utf-8")).hexdigest()
+    return f"stamp-{key}"
+
+
+def output_is_fresh(file):
+    """Return True if file exists and was generated within CACHE_TTL.
+
+    An unchanged output keeps its mtime, so the last generation is also
+    tracked with a stamp file in the cache directory.
+    """
+    if not os.path.exists(file):
+        return False
+    stamp = os.path.join(CACHE_DIR, _stamp(file))
+    return not check_file_date(file) or not check_file_date(stamp)
 
 
-def ref_generator(args, reflist, extraconfs) -> None:
+def write_output(file, output):
+    """Write output to file, leaving it untouched if it is unchanged."""
+    try:
+        with open(file) as f:
+            unchanged = f.read() == output
+    except FileNotFoundError:
+        unchanged = False
+    if unchanged:
+        logging.debug("File content unchanged")
+    else:
+        with open(file, "w") as f:
+            f.write(output)
+    cache_write(_stamp(file), b"")
+
+
+def _emit_choice(config, ref, help_text, custom):
+    lines = [f"config {config}\n"]
+    # Do overwrite ref when custom
+    if custom:
+        lines.append('\tbool "custom"\n')
+    else:
+        lines.append(f'\tbool "{ref}"\n')
+    if help_text:
+        lines.append("\thelp\n")
+        lines.append(f"\t\t{help_text}\n")
+    lines.append("\n")
+    return lines
+
+
+def ref_generator(args, reflist, extraconfs) -> str:
     """Generate output file. Example:
 
     choice
@@ -165,106 +239,180 @@ def ref_generator(args, reflist, extraconfs) -> None:
             default "pending-fixes" if BOOTLINUX_TREE_NEXT_REF_3
             default "stable" if BOOTLINUX_TREE_NEXT_REF_4
     """
-    if os.path.exists(args.output):
-        os.remove(args.output)
-    refs = {}
-
-    with open(args.output, "a") as f:
-        f.write("# SPDX-License-Identifier: copyleft-next-0.3.1\n")
-        f.write("# Automatically generated file\n")
-        f.write("choice\n")
-        f.write('\tprompt "Tag or branch to use"\n\n')
+    refs = []
+    lines = [
+        "# SPDX-License-Identifier: copyleft-next-0.3.1\n",
+        "# Automatically generated file\n",
+        "choice\n",
+        '\tprompt "Tag or branch to use"\n\n',
+    ]
 
     logging.debug("Generating...")
-    refs.update(_ref_generator_choices(args, reflist, len(refs)))
-
-    if extraconfs:
-        for config in extraconfs:
-            refs.update(
-                _ref_generator_choices_static(
-                    args, config["config"], config["ref"], config["help"]
-                )
-            )
+    choices = [(ref, f"{args.prefix}_REF_{i}", None) for i, ref in enumerate(reflist)]
+    choices += [(c["ref"], c["config"], c["help"]) for c in extraconfs or []]
+    for ref, config, help_text in choices:
+        logging.debug(f"{config}: {ref}")
+        custom = "_CUSTOM_NAME" in ref
+        refs.append((ref, config, custom))
+        lines.extend(_emit_choice(config, ref, help_text, custom))
+
+    lines.append("endchoice\n\n")
+    lines.append(f"config {args.prefix}_REF\n")
+    lines.append("\tstring\n")
+    # Do not include quotes when using CUSTOM_NAME
+    lines.append(
+        "".join(
+            f"\tdefault {ref} if {conf}\n"
+            if custom
+            else f'\tdefault "{ref}" if {conf}\n'
+            for ref, conf, custom in refs
+        )
+    )
 
-    with open(args.output, "a") as f:
-        f.write("endchoice\n\n")
-        f.write("config {prefix}_REF\n".format(prefix=args.prefix))
-        f.write("\tstring\n")
-        for r in refs.keys():
-            # Do not include quotes when using CUSTOM_NAME
-            if "_CUSTOM_NAME" in r:
-                f.write('\tdefault {ref} if {conf}\n'.format(ref=r, conf=refs[r]))
-            else:
-                f.write('\tdefault "{ref}" if {conf}\n'.format(ref=r, conf=refs[r]))
+    output = "".join(lines)
+    write_output(args.output, output)
+    return output
 
 
 def remote(args) -> None:
-    heads = popen(
+    # git sorts the whole listing before printing it, so it has to be read
+    # to the end. Only keep the first --refs heads and tags though.
+    count = {"heads": 0, "tags": 0}
+
+    def wanted(refline):
+        if "^{}" in refline:
+            return False
+        for kind in count:
+            if f"\trefs/{kind}/" in refline:
+                count[kind] += 1
+                return count[kind] <= args.refs
+        return False
+
+    p = popen(
         [
             "git",
             "-c",
-            "versionsort.suffix=-",
-            "ls-remote",
-            "--sort=-version:refname",
-            "--heads",
-            args.repo,
-            args.filter_heads,
-        ]
-    )
-    tags = popen(
-        [
-            "git",
+            "protocol.version=2",
             "-c",
             "versionsort.suffix=-",
             "ls-remote",
-            "--sort=-version:refname",
+            "--heads",
             "--tags",
+            "--refs",
+            "--sort=-version:refname",
             args.repo,
-            args.filter_tags,
-        ]
+            f"refs/heads/{args.filter_heads}",
+            f"refs/tags/{args.filter_tags}",
+        ],
+        keep=wanted,
     )
 
-    return [heads["stdout"], tags["stdout"]]
+    # A single ls-remote returns both heads and tags, split them back so
+    # each one keeps its own --refs limit.
+    heads = []
+    tags = []
+    for refline in p["stdout"]:
+        if "\trefs/heads/" in refline:
+            heads.append(refline)
+        elif "\trefs/tags/" in refline:
+            tags.append(refline)
+
+    return [heads, tags]
 
 
 def gitref_getreflist(args, reflist):
     refs = []
-    for refline in reflist.splitlines():
+    for refline in reflist:
         if "^{}" in refline:
             continue
         if len(refs) >= args.refs:
             break
         ref_name = refline.split("/")[-1]
         refs.append(ref_name)
-        logging.debug("release: {}".format(ref_name))
+        logging.debug(f"release: {ref_name}")
     return refs
 
 
 def gitref(args) -> None:
     """Get git reference list using git-ls-remote."""
 
+    # The output only depends on these inputs, reuse a recent result
+    extra_mtime = 0
+    if args.extra and os.path.exists(args.extra):
+        extra_mtime = os.path.getmtime(args.extra)
+    key = hashlib.sha1(
+        repr(
+            (
+                CACHE_VERSION,
+                args.repo,
+                args.filter_heads,
+                args.filter_tags,
+                args.refs,
+                args.prefix,
+                args.extra,
+                extra_mtime,
+            )
+        ).encode("utf-8")
+    ).hexdigest()
+    cache = f"gitref-{key}.kconfig"
+    if not args.force and not check_file_date(
+        os.path.join(CACHE_DIR, cache), args.cache_ttl
+    ):
+        output = cache_read(cache)
+        if output is not None:
+            logging.debug(f"Using cached output for {args.repo}")
+            write_output(args.output, output.decode("utf-8"))
+            return
+
     extraconfs = []
     if args.extra:
         if os.path.exists(args.extra):
             with open(args.extra, mode="rt") as f:
-                yml = yaml.safe_load(f)
+                yml = yaml.load(f, Loader=YamlLoader)
                 extraconfs = yml["configs"]
 
     refstr = remote(args)
     reflist = []
     for rl in refstr:
-        _refs = gitref_getreflist(args, rl)
-        for r in _refs:
-            reflist.append(r)
+        reflist.extend(gitref_getreflist(args, rl))
 
-    ref_generator(args, reflist, extraconfs)
+    output = ref_generator(args, reflist, extraconfs)
+    # An empty list means git-ls-remote failed, retry on the next run
+    if reflist:
+        cache_write(cache, output.encode("utf-8"))
 
 
 def kreleases(args) -> None:
     """Get the latest kernel releases from kernel.org/releases.json"""
 
-    with urllib.request.urlopen("https://www.kernel.org/releases.json") as url:
-        data = json.load(url)
+    # Revalidate the cached copy, kernel.org replies 304 when unchanged
+    req = urllib.request.Request(
+        "https://www.kernel.org/releases.json", headers={"Accept-Encoding": "gzip"}
+    )
+    raw = cache_read("releases.json")
+    headers = cache_read("releases.json.headers")
+    if raw is not None and headers is not None:
+        for name, value in json.loads(headers).items():
+            req.add_header(name, value)
+
+    try:
+        with urllib.request.urlopen(req) as url:
+            raw = url.read()
+            if url.headers.get("Content-Encoding") == "gzip":
+                raw = gzip.decompress(raw)
+            headers = {}
+            if url.headers.get("ETag"):
+                headers["If-None-Match"] = url.headers["ETag"]
+            if url.headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = url.headers["Last-Modified"]
+        cache_write("releases.json", raw)
+        cache_write("releases.json.headers", json.dumps(headers).encode("utf-8"))
+    except urllib.error.HTTPError as exc:
+        if exc.code != 304 or raw is None:
+            raise
+        logging.debug("releases.json not modified, using cached copy")
+
+    data = json_loads(raw)
 
     reflist = []
     for release in data["releases"]:
@@ -283,7 +431,7 @@ def main() -> None:
     if args.debug:
         log.setLevel(logging.DEBUG)
 
-    if not args.force and not check_file_date(args.output):
+    if not args.force and output_is_fresh(args.output):
         logging.debug("File already updated")
         return
 